@@ -7,7 +7,7 @@ import jvd.capa.file as e_file
 import jvd.capa.function as e_func
 import jvd.capa.ins as e_ins
 from jvd.capa.data import DataUnit
-from jvd.utils import download_file, read_gz_js
+from jvd.utils import download_file, load_augmented
 from jvd.resources import ResourceAbstract, require
 
 import capa
@@ -38,7 +38,7 @@ class JVDExtractor(FeatureExtractor):
     def __init__(self, gz_file, bin_path):
         super(JVDExtractor, self).__init__()
         if isinstance(gz_file, str):
-            gz_file = read_gz_js(gz_file)
+            gz_file = load_augmented(gz_file)
         self.data_unit = DataUnit(gz_file, bin_path)
 
     def get_base_address(self):
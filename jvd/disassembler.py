@@ -1,88 +1,216 @@
-import gzip
-import json
+import atexit
 import logging
 import os
+import platform
 import re
 import tempfile
 from abc import ABCMeta, abstractmethod
 from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial
+from itertools import chain
 from pathlib import Path
-from shutil import copyfile, rmtree, unpack_archive
+from shutil import copyfileobj, rmtree, unpack_archive
 
+import numpy as np
 from tqdm import tqdm
 
-from jvd.utils import read_gz_js, write_gz_js, get_file_type, grep_ext, m_map
-from jvd.capa import capa_analyze, CapaJsonObjectEncoder
+from jvd.utils import (
+    AUGMENTED_FIELDS, META_EXT, get_file_type, grep_ext, load_augmented,
+    write_ftype, write_zst_js)
+
+JS_EXT = '.asm.json.gz'
+
+
+def _max_workers():
+    max_workers = os.cpu_count()
+    if platform.system() == 'Windows':
+        # windows hard limit is 61
+        max_workers = min(max_workers, 55)
+    return max_workers
+
+
+def _worker_init():
+    # import the backends once per worker so that tasks start hot
+    import jvd.ghidra  # noqa: F401
+    import jvd.ida  # noqa: F401
+
+
+# worker processes shared by all `disassemble_all` calls
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=_max_workers(), initializer=_worker_init)
+    return _pool
+
+
+def _shutdown_pool(wait=True):
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=wait)
+        _pool = None
+
+
+atexit.register(_shutdown_pool)
+
+
+def _disassemble_batch(fn, files):
+    return [fn(f) for f in files]
+
+
+def _fast_copy(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if hasattr(os, 'sendfile'):
+            # zero-copy in kernel space
+            try:
+                size = os.fstat(fsrc.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(
+                        fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                if offset >= size:
+                    return dst
+                fsrc.seek(offset)
+                fdst.seek(offset)
+            except OSError:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        copyfileobj(fsrc, fdst, length=1 << 20)
+    return dst
 
 
 class DisassemblerAbstract(metaclass=ABCMeta):
 
+    # gzip level used when a backend re-writes the asm json file
+    # (1 favors speed; archive runs can raise it up to 9)
+    compresslevel = 1
+    # zstd level used for the augmentation sidecar (see `load_augmented`)
+    meta_compresslevel = 3
+    # backends that write next to (or modify) the input file are run on a
+    # copy of it inside a temporary folder
+    _requires_staging = False
+
     @abstractmethod
     def _process(self, file, file_type, output_file_path, decompile=False):
         pass
 
     def _cfg(self, res):
-        blk2ind = {b['addr_start']: ind
-                   for ind, b in enumerate(res['blocks'])}
-        adj_sp = [(blk2ind[b['addr_start']], blk2ind[c])
-                  for b in res['blocks'] for c in b['calls'] if c in blk2ind]
+        # pull the block table apart into columns in a single pass
+        blocks = res['blocks']
+        block_starts = [b['addr_start'] for b in blocks]
+        block_calls = [b['calls'] for b in blocks]
+        flat_calls = list(chain.from_iterable(block_calls))
+        # kernel and other high-half addresses do not fit in an int64
+        dtype = np.int64 if min(
+            chain(block_starts, flat_calls), default=0) < 0 else np.uint64
+        try:
+            starts = np.array(block_starts, dtype=dtype)
+            calls = np.array(flat_calls, dtype=dtype)
+        except OverflowError:
+            # mixed signs beyond 64 bits; fall back to a plain lookup
+            blk2ind = {a: ind for ind, a in enumerate(block_starts)}
+            res['cfg'] = [
+                (blk2ind[b['addr_start']], blk2ind[c])
+                for b in blocks for c in b['calls'] if c in blk2ind]
+            return res
+        # map addresses to block indices; like a dict keyed by address,
+        # the last block wins when several share the same start
+        order = np.argsort(starts, kind='stable')
+        sorted_starts = starts[order]
+        start_ind = order[
+            np.searchsorted(sorted_starts, starts, side='right') - 1]
+        owner = np.repeat(
+            start_ind, np.fromiter(
+                map(len, block_calls), np.int64, len(blocks)))
+        pos = np.searchsorted(sorted_starts, calls, side='right') - 1
+        mask = pos >= 0
+        mask[mask] = sorted_starts[pos[mask]] == calls[mask]
+        adj_sp = list(zip(
+            owner[mask].tolist(), order[pos[mask]].tolist()))
         res['cfg'] = adj_sp
         return res
 
     def disassemble(
             self, file, decompile=False, cleanup=False, cfg=False,
             no_result=False, file_type=None, capa=False, verbose=-1,
-            additional_ext=''):
-        js_file = file + '{}.asm.json.gz'.format(additional_ext)
+            additional_ext='', _skip_exists_check=False):
+        js_file = file + additional_ext + JS_EXT
         res = None
         log = []
-        file_type = file_type if file_type else get_file_type(file)
-        if os.path.exists(js_file):
+        if not _skip_exists_check and os.path.exists(js_file):
             log.append('directly reading the generated json file')
         else:
-            tmp_folder = file + '{}.tmp'.format(additional_ext)
+            file_type = file_type if file_type else get_file_type(file)
+            tmp_folder = None
+            src_file = file
+            part_file = js_file + '.part'
             try:
-                os.mkdir(tmp_folder)
-                new_file = os.path.join(tmp_folder, os.path.basename(file))
-                new_file_js = os.path.join(
-                    tmp_folder, os.path.basename(js_file))
-                copyfile(file, new_file)
+                if self._requires_staging:
+                    staging = file + '{}.tmp'.format(additional_ext)
+                    os.mkdir(staging)
+                    tmp_folder = staging
+                    src_file = os.path.join(
+                        tmp_folder, os.path.basename(file))
+                    part_file = os.path.join(
+                        tmp_folder, os.path.basename(js_file))
+                    _fast_copy(file, src_file)
                 _, out_log = self._process(
-                    new_file, file_type, output_file_path=new_file_js, decompile=decompile)
-                copyfile(new_file_js, js_file)
-                if isinstance(log, list):
-                    log.extend(log)
+                    src_file, file_type, output_file_path=part_file,
+                    decompile=decompile)
+                # augmentations of a previous output do not apply anymore
+                if os.path.exists(js_file + META_EXT):
+                    os.remove(js_file + META_EXT)
+                # the staging folder sits next to the file (same device)
+                os.replace(part_file, js_file)
+                if isinstance(out_log, list):
+                    log.extend(out_log)
                 else:
-                    log.append(str(log))
+                    log.append(str(out_log))
             except Exception as e:
                 log.append(str(e))
                 if verbose > 1:
                     raise e
                 return None, log
             finally:
-                rmtree(tmp_folder)
-                pass
+                if tmp_folder:
+                    rmtree(tmp_folder)
+                elif os.path.exists(part_file):
+                    os.remove(part_file)
 
         try:
-            res = read_gz_js(js_file)
+            # only keep the parsed json around if it is handed back
+            res = load_augmented(js_file, cached=not no_result)
             changed = False
-            if 'f_type' not in res:
-                res['bin']['f_type'] = file_type
-                changed = True
+            if 'f_type' not in res['bin']:
+                f_type = file_type if file_type else get_file_type(file)
+                # only fall back to the sidecar if xattrs are unusable
+                changed = not write_ftype(js_file, f_type)
+                res['bin']['f_type'] = f_type
             if cfg and 'cfg' not in res:
                 self._cfg(res)
                 changed = True
             if capa and 'capa' not in res:
+                # capa is heavy, so it is only imported when asked for
+                from jvd.capa import capa_analyze
                 res['capa'] = capa_analyze(res, file, verbose=verbose)
                 changed = True
             if changed:
-                content = json.dumps(
-                    res,
-                    cls=CapaJsonObjectEncoder,
-                ).encode('utf-8')
-                with gzip.GzipFile(js_file, 'w') as gf:
-                    gf.write(content)
+                meta = {k: res[k] for k in AUGMENTED_FIELDS if k in res}
+                meta['f_type'] = res['bin']['f_type']
+                cls = None
+                if 'capa' in meta:
+                    from jvd.capa import CapaJsonObjectEncoder as cls
+                write_zst_js(
+                    meta, js_file + META_EXT, cls=cls,
+                    level=self.meta_compresslevel)
             if no_result:
                 return js_file if res else None, log
             return res, log
@@ -115,10 +243,10 @@ class DisassemblerAbstract(metaclass=ABCMeta):
         pass
 
     def cleanup(self, file):
-        js_file = file + '.asm.json.gz'
-        if os.path.exists(js_file):
-            os.remove(js_file)
-        pass
+        js_file = file + JS_EXT
+        for f in (js_file, js_file + META_EXT):
+            if os.path.exists(f):
+                os.remove(f)
 
     def disassemble_all(
             self,
@@ -137,25 +265,57 @@ class DisassemblerAbstract(metaclass=ABCMeta):
         else:
             files = path_or_files
 
+        skip_exists_check = False
+        if not (cfg or capa or cleanup):
+            # nothing to add to the already generated files, so skip them
+            # with one listing per folder instead of one stat per sample
+            done = set()
+            for folder in set(os.path.dirname(f) for f in files):
+                with os.scandir(folder or '.') as it:
+                    done.update(
+                        (folder, e.name[:-len(JS_EXT)])
+                        for e in it if e.name.endswith(JS_EXT))
+            files = [f for f in files if (
+                os.path.dirname(f), os.path.basename(f)) not in done]
+            skip_exists_check = True
+
         logging.info('{} files to process'.format(len(files)))
 
         def gen():
             if multiprocessing:
-                yield from m_map(
-                    partial(
-                        self.disassemble, decompile=decompile,
-                        cleanup=cleanup, cfg=cfg, no_result=True,
-                        capa=capa, verbose=verbose), files
-                )
-                with ProcessPoolExecutor(max_workers=50) as e:
-                    for ind, extracted in enumerate(
-                            e.map()):
-                        yield ind, extracted
+                ex = _get_pool()
+                fn = partial(
+                    self.disassemble, decompile=decompile,
+                    cleanup=cleanup, cfg=cfg, no_result=True,
+                    capa=capa, verbose=verbose,
+                    _skip_exists_check=skip_exists_check)
+                # batch several files per task to cut down ipc round-trips
+                chunksize = max(1, len(files) // (_max_workers() * 4))
+                futures = [
+                    ex.submit(_disassemble_batch, fn,
+                              files[i:i + chunksize])
+                    for i in range(0, len(files), chunksize)]
+                try:
+                    ind = 0
+                    for future in futures:
+                        for extracted in future.result():
+                            yield ind, extracted
+                            ind += 1
+                except BrokenProcessPool:
+                    # a worker died; start over with a fresh pool next time
+                    _shutdown_pool(wait=False)
+                    raise
+                finally:
+                    # the pool outlives this call: drop what was not
+                    # consumed (e.g. the caller stopped early)
+                    for future in futures:
+                        future.cancel()
             else:
                 for ind, f in enumerate(files):
                     extracted = self.disassemble(
                         f, decompile=decompile, cleanup=cleanup, cfg=cfg,
-                        no_result=True, capa=capa, verbose=verbose)
+                        no_result=True, capa=capa, verbose=verbose,
+                        _skip_exists_check=skip_exists_check)
                     yield ind, extracted
 
         for ind, extracted in tqdm(gen(), total=len(files)):
@@ -1,4 +1,3 @@
-import gzip
 import json
 from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
@@ -6,15 +5,14 @@ from subprocess import check_call
 import pathlib
 import os
 
+from jvd.utils import load_augmented
+
 
 def _default_fs_mapper(file):
     if isinstance(file, dict):
         return file
-    if file.with_suffix('.gz'):
-        with gzip.open(
-                file, 'rt',
-                encoding='utf-8') as zipfile:
-            return json.load(zipfile)
+    if str(file).endswith('.gz'):
+        return load_augmented(str(file))
     else:
         with open(file, 'r', encoding='utf-8') as rf:
             return json.load(rf)
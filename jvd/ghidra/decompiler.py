@@ -18,15 +18,24 @@ class Ghidra(DisassemblerAbstract):
 
     def _process(self, file, file_type, output_file_path, decompile=False):
         log = None
-        js_file, log = process(
-            self.java, self.jar, file,
-            output_file_path, decompile=decompile)
+        # one project folder per output (so per `additional_ext` as well);
+        # it sits next to the sample, so never leave it behind
+        project_dir = os.path.abspath(output_file_path + '.ghidra')
+        try:
+            js_file, log = process(
+                self.java, self.jar, file,
+                output_file_path, decompile=decompile,
+                project_dir=project_dir)
+        finally:
+            if os.path.exists(project_dir):
+                rmtree(project_dir)
         return js_file, log
 
 
 def process(java, jar, file, json_file, project_suffix='.ghidra',
-            decompile=False, func_entries=None):
-    project_dir = file + project_suffix
+            decompile=False, func_entries=None, project_dir=None):
+    if project_dir is None:
+        project_dir = file + project_suffix
 
     file = os.path.abspath(file)
     json_file = os.path.abspath(json_file)
@@ -24,6 +24,9 @@ ida_available = which('ida64.exe' if platform.system()
 
 class IDA(DisassemblerAbstract):
 
+    # ida creates its database files next to the input
+    _requires_staging = True
+
     def __init__(self):
         if not ida_available:
             raise FileNotFoundError('IDA is not found!')
@@ -80,7 +83,8 @@ class IDA(DisassemblerAbstract):
             for f in src:
                 f['addr_start'] = f['addr_start'] - base_diff
             obj['functions_src'] = src
-            write_gz_js(obj, output_file_path)
+            write_gz_js(obj, output_file_path,
+                        compresslevel=self.compresslevel)
 
         return output_file_path, log
 
@@ -1,18 +1,22 @@
 import logging as log
 import os
 import platform
-import urllib
+import urllib.error
+import urllib.request
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from shutil import rmtree, unpack_archive
+from shutil import rmtree
 
 import pytz
 from dateutil.tz import tzlocal
 
-from jvd.utils import download_file, fn_from_url, unzip_with_permission
+from jvd.utils import download_file, extract_archive, fn_from_url
 
 
+@lru_cache()
 def internet_on():
     try:
         urllib.request.urlopen('http://www.google.com/', timeout=1)
@@ -25,6 +29,17 @@ def internet_on():
 online = internet_on()
 
 
+@lru_cache(maxsize=None)
+def _remote_mtime(url):
+    # HEAD only: no need to pull the body for the header
+    req = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(req) as u:
+        url_time = u.info()['Last-Modified']
+    url_date = datetime.strptime(
+        url_time, "%a, %d %b %Y %X GMT")
+    return pytz.utc.localize(url_date)
+
+
 class ResourceAbstract(metaclass=ABCMeta):
 
     home = os.path.join(str(Path.home()), 'jv-dependencies')
@@ -62,12 +77,7 @@ class ResourceAbstract(metaclass=ABCMeta):
         download = not os.path.exists(file)
         if not download and self.check_update and online:
             try:
-                u = urllib.request.urlopen(url)
-                meta = u.info()
-                url_time = meta['Last-Modified']
-                url_date = datetime.strptime(
-                    url_time, "%a, %d %b %Y %X GMT")
-                url_date = pytz.utc.localize(url_date)
+                url_date = _remote_mtime(url)
                 file_time = datetime.fromtimestamp(
                     os.path.getmtime(file), tz=tzlocal())
 
@@ -92,15 +102,13 @@ class ResourceAbstract(metaclass=ABCMeta):
 
         if self.unpack and unpack_if_needed:
             if not os.path.exists(file_unpack):
-                if self.with_permission:
-                    unzip_with_permission(file, file_unpack)
-                else:
-                    unpack_archive(file, file_unpack)
+                extract_archive(
+                    file, file_unpack, with_permission=self.with_permission)
             return file_unpack
         else:
             return file
 
-    def cache(self, root):
+    def cache(self, root, show_progress=True):
         url = self.default
         if self.linux:
             url = self.linux
@@ -109,13 +117,21 @@ class ResourceAbstract(metaclass=ABCMeta):
         if self.windows:
             url = self.windows
         self._download(
-            url, show_progress=True,
+            url, show_progress=show_progress,
             unpack_if_needed=False, home=root)
 
 
 def cache_all(root=ResourceAbstract.home):
-    for res in ResourceAbstract.__subclasses__():
-        res = res().cache(root)
+    resources = ResourceAbstract.__subclasses__()
+    # downloads are network bound, so threads are enough
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(resources)))) as e:
+        # concurrent progress bars would overwrite each other's line
+        futures = [e.submit(
+            lambda res: res().cache(root, show_progress=False), res)
+            for res in resources]
+    # all downloads are finished (or failed) by now; surface the errors
+    for f in futures:
+        f.result()
 
 
 def require(library):
@@ -1,5 +1,4 @@
 import datetime
-import gzip
 import hashlib
 import io
 import json
@@ -9,26 +8,73 @@ import os
 import platform
 import re
 import subprocess
+import tarfile
+import tempfile
+import threading
 import urllib.error
 import urllib.parse
 import urllib.request
 from multiprocessing import Pool
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, redirect_stderr, redirect_stdout
-from functools import partial
+from functools import lru_cache, partial
 from pathlib import Path
-from shutil import unpack_archive
+from shutil import copyfileobj, rmtree, unpack_archive
 from zipfile import ZipFile, ZipInfo
 
 import magic
 import requests
+import zstandard
 from tqdm import tqdm
 
+try:
+    # isa-l backed drop-in replacement for gzip (much faster deflate/inflate)
+    from isal import igzip as gzip
+    GZ_LEVEL_BEST = 3
+except ImportError:
+    import gzip
+    GZ_LEVEL_BEST = 9
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def fn_from_url(url):
     return os.path.basename(urllib.parse.urlparse(url).path)
 
 
-def download_file(url, dest, progress=False):
+class _RangeNotHonored(IOError):
+    pass
+
+
+def _download_range(url, dest, start, end, pg=None):
+    r = requests.get(url, stream=True, headers={
+        'Range': 'bytes={}-{}'.format(start, end),
+        'Accept-Encoding': 'identity'})
+    r.raise_for_status()
+    if r.status_code != 206:
+        r.close()
+        raise _RangeNotHonored(
+            'Range request not honored by {}'.format(url))
+    written = 0
+    with open(dest, 'r+b') as f:
+        f.seek(start)
+        for chunk in r.iter_content(chunk_size=1 << 20):
+            if chunk:
+                if pg:
+                    pg.update(len(chunk))
+                f.write(chunk)
+                written += len(chunk)
+    # the file is preallocated: a short range would leave a hole of zeros
+    if written != end - start + 1:
+        raise IOError('Incomplete range {}-{} from {}: got {} bytes'.format(
+            start, end, url, written))
+
+
+def download_file(url, dest, progress=False, parts=4):
 
     if os.path.exists(dest) and progress:
         log.info('File already exists {} ...'.format(dest))
@@ -36,27 +82,74 @@ def download_file(url, dest, progress=False):
         if progress:
             log.info('downloading from: %s to %s', url, dest)
 
-        r = requests.get(url, stream=True)
-        total_length = r.headers.get('content-length')
-        pg = tqdm(total=int(total_length)) if (
+        tmp = dest + '.part'
+        h = requests.head(
+            url, allow_redirects=True,
+            headers={'Accept-Encoding': 'identity'})
+        total_length = h.headers.get('content-length') if h.ok else None
+        total_length = int(total_length) if total_length else None
+        ranged = total_length is not None and h.headers.get(
+            'accept-ranges', '').lower() == 'bytes'
+        pg = tqdm(total=total_length) if (
             total_length is not None and progress) else None
-        dl = 0
-        with open(dest, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    if progress and pg:
-                        pg.update(len(chunk))
-                    f.write(chunk)
-                    f.flush()
-        if progress and pg:
-            pg.close()
+        # split into ranges fetched in parallel only if large enough
+        ranged = ranged and parts > 1 and total_length >= parts << 20
+        try:
+            if ranged:
+                with open(tmp, 'wb') as f:
+                    f.truncate(total_length)
+                step = -(-total_length // parts)
+                with ThreadPoolExecutor(max_workers=parts) as e:
+                    futures = [
+                        e.submit(_download_range, h.url, tmp, start,
+                                 min(start + step, total_length) - 1, pg)
+                        for start in range(0, total_length, step)]
+                try:
+                    for f in futures:
+                        f.result()
+                except _RangeNotHonored:
+                    # advertised ranges but sent the whole body; start over
+                    log.info('Ranges not honored by %s, retrying as a '
+                             'single stream', url)
+                    os.remove(tmp)
+                    if pg:
+                        pg.reset()
+                    ranged = False
+            if not ranged:
+                with urllib.request.urlopen(url) as r, \
+                        open(tmp, 'wb') as f:
+                    if pg is None:
+                        copyfileobj(r, f, length=1 << 20)
+                    else:
+                        for chunk in iter(lambda: r.read(1 << 20), b''):
+                            pg.update(len(chunk))
+                            f.write(chunk)
+                    expected = r.headers.get('content-length')
+                    if expected is not None and f.tell() != int(expected):
+                        raise IOError(
+                            'Incomplete download from {}: got {} of {} '
+                            'bytes'.format(url, f.tell(), expected))
+        except BaseException:
+            # never let a partial file be picked up as the cached copy
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            if progress and pg:
+                pg.close()
+        os.replace(tmp, dest)
 
     return dest
 
 
+def _read_gz(file):
+    with open(file, 'rb', buffering=1 << 20) as raw, \
+            gzip.GzipFile(fileobj=raw, mode='rb') as fin:
+        return fin.read()
+
+
 def read_gz_js(file, as_attrdict=False):
-    with gzip.open(file, 'r') as fin:
-        json_bytes = fin.read()
+    json_bytes = _read_gz(file)
 
     json_str = json_bytes.decode('utf-8')
     data = json.loads(json_str)
@@ -65,18 +158,173 @@ def read_gz_js(file, as_attrdict=False):
     return data
 
 
-def write_gz_js(obj, file, cls=None):
-    content = json.dumps(
-        obj,
-        cls=cls,
-    ).encode('utf-8')
-    with gzip.GzipFile(file, 'w') as gf:
-        gf.write(content)
+# bound the cache by the total size of the decompressed content, as a single
+# disassembly can run into hundreds of megabytes
+GZ_CACHE_BYTES = 256 << 20
+_gz_cache = OrderedDict()
+_gz_cache_size = 0
+_gz_cache_lock = threading.Lock()
+
+
+def _read_gz_cached(file, key):
+    global _gz_cache_size
+    with _gz_cache_lock:
+        cached = _gz_cache.get(file)
+        if cached is not None and cached[0] == key:
+            _gz_cache.move_to_end(file)
+            return cached[1]
+    data = _read_gz(file)
+    # anything taking more than a quarter of the budget is not worth keeping
+    if len(data) > GZ_CACHE_BYTES >> 2:
+        return data
+    with _gz_cache_lock:
+        old = _gz_cache.pop(file, None)
+        if old is not None:
+            _gz_cache_size -= len(old[1])
+        _gz_cache[file] = (key, data)
+        _gz_cache_size += len(data)
+        while _gz_cache_size > GZ_CACHE_BYTES:
+            _, (_, evicted) = _gz_cache.popitem(last=False)
+            _gz_cache_size -= len(evicted)
+    return data
+
+
+def read_gz_js_cached(file):
+    """ Like `read_gz_js`, but keeps the decompressed content of recently
+        read files in memory (up to `GZ_CACHE_BYTES` in total). It is parsed
+        on every call, so each caller gets its own object.
+    """
+    st = os.stat(file)
+    json_bytes = _read_gz_cached(file, (st.st_mtime_ns, st.st_size))
+    return json.loads(json_bytes.decode('utf-8'))
+
+
+def _dump_js(obj, fp, cls=None):
+    if orjson is not None:
+        # reuse the encoder's fallback for types orjson cannot handle
+        default = cls().default if cls else None
+        fp.write(orjson.dumps(
+            obj, default=default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+    else:
+        tw = io.TextIOWrapper(fp, encoding='utf-8')
+        json.dump(
+            obj, tw,
+            cls=cls,
+            separators=(',', ':'),
+            ensure_ascii=False,
+        )
+        tw.flush()
+        tw.detach()
+
+
+def _write_pigz_js(obj, file, pigz, cls=None, compresslevel=1, threads=1):
+    cmd = [pigz, '-{}'.format(compresslevel), '-p', str(threads), '-c']
+    with open(file, 'wb') as raw:
+        p = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=raw, bufsize=1 << 20)
+        try:
+            _dump_js(obj, p.stdin, cls=cls)
+        finally:
+            p.stdin.close()
+            ret = p.wait()
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+
+
+def write_gz_js(obj, file, cls=None, compresslevel=None, threads=None):
+    # favors speed unless told otherwise; isal only supports levels 0-3
+    compresslevel = min(
+        1 if compresslevel is None else compresslevel, GZ_LEVEL_BEST)
+    pigz = which('pigz')
+    if pigz:
+        if threads is None:
+            # inside a worker process the pool already uses every core
+            threads = 1 if multiprocessing.parent_process() else \
+                os.cpu_count()
+        # multi-threaded deflate
+        return _write_pigz_js(
+            obj, file, pigz, cls=cls, compresslevel=compresslevel,
+            threads=threads)
+    with open(file, 'wb') as raw, \
+            gzip.GzipFile(fileobj=raw, mode='wb',
+                          compresslevel=compresslevel) as gf, \
+            io.BufferedWriter(gf, buffer_size=1 << 20) as bw:
+        _dump_js(obj, bw, cls=cls)
+
+
+def read_zst_js(file):
+    with open(file, 'rb') as raw, \
+            zstandard.ZstdDecompressor().stream_reader(raw) as fin:
+        json_bytes = fin.read()
+    return json.loads(json_bytes.decode('utf-8'))
+
+
+def write_zst_js(obj, file, cls=None, level=3):
+    with open(file, 'wb') as raw, \
+            zstandard.ZstdCompressor(level=level).stream_writer(raw) as zw:
+        _dump_js(obj, zw, cls=cls)
+
+
+# fields added on top of the disassembler output (along with bin.f_type);
+# kept in a small sidecar so the large asm json never gets re-compressed
+AUGMENTED_FIELDS = ('cfg', 'capa')
+META_EXT = '.meta.json.zst'
+FTYPE_XATTR = 'user.jvd.f_type'
+
+
+def read_ftype(js_file):
+    if hasattr(os, 'getxattr'):
+        try:
+            return os.getxattr(js_file, FTYPE_XATTR).decode('utf-8')
+        except OSError:
+            pass
+    return None
+
+
+def write_ftype(js_file, f_type):
+    # tiny metadata goes to an extended attribute (linux) to avoid
+    # writing the sidecar just for the file type
+    if hasattr(os, 'setxattr'):
+        try:
+            os.setxattr(js_file, FTYPE_XATTR, f_type.encode('utf-8'))
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def load_augmented(js_file, cached=False):
+    """ Read a generated `.asm.json.gz` file along with the fields that
+        were added to it later on (f_type, cfg, capa).
+    """
+    if cached:
+        res = read_gz_js_cached(js_file)
+    else:
+        res = read_gz_js(js_file)
+    meta_file = js_file + META_EXT
+    if os.path.exists(meta_file):
+        meta = read_zst_js(meta_file)
+        if 'f_type' in meta:
+            res['bin']['f_type'] = meta.pop('f_type')
+        res.update(meta)
+    if 'f_type' not in res['bin']:
+        f_type = read_ftype(js_file)
+        if f_type is not None:
+            res['bin']['f_type'] = f_type
+    return res
+
+
+@lru_cache(maxsize=None)
+def _file_type(file, inode, mtime):
+    return magic.from_file(file)
 
 
 def get_file_type(file):
     if isinstance(file, str):
-        return magic.from_file(file)
+        # libmagic is only consulted again if the file has changed
+        st = os.stat(file)
+        return _file_type(file, st.st_ino, st.st_mtime_ns)
     else:
         return magic.from_buffer(file)
 
@@ -113,13 +361,22 @@ def sha256sum(filename):
 
 
 def grep_ext(folder, ext=None):
-    paths = [p for p in Path(
-        folder).rglob('*') if p.is_file()]
-    if ext:
-        paths = [str(p) for p in paths if len(ext) < 1
-                 or p.suffix == ext or str(p).endswith(ext)]
-    else:
-        paths = [str(p) for p in paths]
+    paths = []
+    folders = [folder]
+    while folders:
+        try:
+            it = os.scandir(folders.pop())
+        except PermissionError:
+            # skip what cannot be listed, like a walk would
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                # match on the name before touching the file's metadata
+                elif (not ext or entry.name.endswith(ext)) \
+                        and entry.is_file():
+                    paths.append(entry.path)
     return paths
 
 
@@ -283,3 +540,39 @@ def unzip_with_permission(zip_file, dest):
         with ZipFileWithPermissions(zip_file) as zfp:
             zfp.extractall(dest)
     return dest
+
+
+TAR_EXTS = ('.tar', '.tar.gz', '.tgz', '.tar.xz', '.txz', '.tar.bz2', '.tbz2')
+
+
+def extract_archive(archive, dest, with_permission=False):
+    """
+    Extract into a temporary folder next to `dest` and move it into place
+    once complete, so a partially extracted archive is never picked up.
+    """
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(dest)))
+    try:
+        name = archive.lower()
+        if name.endswith(TAR_EXTS):
+            # streaming mode: sequential reads with a large block size
+            with tarfile.open(archive, mode='r|*', bufsize=1 << 20) as tf:
+                tf.extractall(tmp)
+        elif name.endswith('.zip'):
+            zip_cls = ZipFileWithPermissions if with_permission else ZipFile
+            with zip_cls(archive) as zfp:
+                zfp.extractall(tmp)
+        else:
+            unpack_archive(archive, tmp)
+        # mkdtemp creates the folder as owner-only
+        os.chmod(tmp, 0o755)
+        try:
+            os.replace(tmp, dest)
+        except OSError:
+            # another process unpacked the same archive first; keep theirs
+            if not os.path.isdir(dest):
+                raise
+            rmtree(tmp, ignore_errors=True)
+    except BaseException:
+        rmtree(tmp, ignore_errors=True)
+        raise
+    return dest
@@ -42,7 +42,9 @@ setup(
         'pygments',
         'javalang >= 0.13.0',
         'pydot >= 1.4.2',
-        'networkx'
+        'networkx',
+        'numpy',
+        'zstandard'
     ],
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -0,0 +1,96 @@
+import os
+
+from jvd.utils import (
+    META_EXT, grep_ext, load_augmented, read_gz_js, read_zst_js, write_gz_js,
+    write_zst_js)
+
+
+def test_cfg():
+    # imported here: the disassembler module pulls in capa
+    from jvd.disassembler import DisassemblerAbstract
+
+    class _NoBackend(DisassemblerAbstract):
+
+        def _process(self, file, file_type, output_file_path,
+                     decompile=False):
+            pass
+
+    res = {'blocks': [
+        {'addr_start': 0x10, 'calls': [0x20, 0x99]},
+        {'addr_start': 0x20, 'calls': [0x10, 0x30]},
+        {'addr_start': 0x30, 'calls': []},
+        # duplicated start: the last block with a given address wins
+        {'addr_start': 0x20, 'calls': [0x30]},
+    ]}
+    _NoBackend()._cfg(res)
+    assert res['cfg'] == [(0, 3), (3, 0), (3, 2), (3, 2)]
+
+    # kernel-space addresses do not fit in a signed 64-bit integer
+    res = {'blocks': [
+        {'addr_start': 0xffffffff81000000, 'calls': [0xffffffff81000040]},
+        {'addr_start': 0xffffffff81000040, 'calls': [0xffffffff81000000]},
+    ]}
+    _NoBackend()._cfg(res)
+    assert res['cfg'] == [(0, 1), (1, 0)]
+
+    # and a mix of signs past 64 bits still resolves
+    res = {'blocks': [
+        {'addr_start': -1, 'calls': [1 << 64]},
+        {'addr_start': 1 << 64, 'calls': [-1, 5]},
+    ]}
+    _NoBackend()._cfg(res)
+    assert res['cfg'] == [(0, 1), (1, 0)]
+
+    res = {'blocks': []}
+    _NoBackend()._cfg(res)
+    assert res['cfg'] == []
+
+
+def test_sidecar_round_trip(tmp_path):
+    js_file = str(tmp_path / 'sample.bin.asm.json.gz')
+    obj = {'bin': {'base': 0}, 'blocks': [{'addr_start': 1, 'calls': []}]}
+    write_gz_js(obj, js_file)
+    assert load_augmented(js_file) == obj
+
+    meta = {'f_type': 'ELF 64-bit', 'cfg': [[0, 0]], 'capa': {'tac': []}}
+    write_zst_js(meta, js_file + META_EXT)
+    assert read_zst_js(js_file + META_EXT) == meta
+
+    for cached in (False, True):
+        res = load_augmented(js_file, cached=cached)
+        assert res['bin']['f_type'] == 'ELF 64-bit'
+        assert res['cfg'] == [[0, 0]]
+        assert res['capa'] == {'tac': []}
+        assert res['blocks'] == obj['blocks']
+        # callers get their own object
+        res['blocks'].append({})
+    # the asm json itself is left untouched
+    assert read_gz_js(js_file) == obj
+
+
+def test_grep_ext(tmp_path):
+    os.makedirs(str(tmp_path / 'a' / 'b'))
+    for f in ('x.bin', 'y.o', os.path.join('a', 'z.bin'),
+              os.path.join('a', 'b', 'w.bin')):
+        (tmp_path / f).write_bytes(b'')
+
+    found = sorted(grep_ext(str(tmp_path), ext='.bin'))
+    assert found == sorted(str(tmp_path / f) for f in (
+        'x.bin', os.path.join('a', 'z.bin'), os.path.join('a', 'b', 'w.bin')))
+    assert len(grep_ext(str(tmp_path))) == 4
+
+
+def test_grep_ext_skips_unreadable(tmp_path, monkeypatch):
+    os.makedirs(str(tmp_path / 'locked'))
+    (tmp_path / 'x.bin').write_bytes(b'')
+    (tmp_path / 'locked' / 'y.bin').write_bytes(b'')
+
+    scandir = os.scandir
+
+    def _scandir(path):
+        if os.path.basename(path) == 'locked':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', _scandir)
+    assert grep_ext(str(tmp_path), ext='.bin') == [str(tmp_path / 'x.bin')]